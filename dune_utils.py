@@ -4,10 +4,22 @@ Shared utilities for Dune sync operations
 """
 
 import os
+import json
+import time
+import zlib
+import gzip
+import itertools
+import shutil
 import logging
+import functools
+import traceback
 from pathlib import Path
 from datetime import datetime
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
 # Load environment variables from .env file first
 try:
     import dotenv
@@ -15,67 +27,251 @@ try:
 except ImportError:
     pass  # dotenv not available, continue without it
 
+# Use orjson for faster JSON (de)serialization if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson not available, fall back to stdlib json
+
 
 def setup_logging():
     """Setup logging configuration"""
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
     return logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
+def _cached_dune_client():
+    from dune_client.client import DuneClient
+    return DuneClient.from_env()
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_api_key():
+    return os.getenv('DUNE_API_KEY')
+
+
+def get_api_key():
+    """Get Dune API key from environment (same way DuneClient.from_env() does)"""
+    return _cached_api_key()
+
+
 def get_dune_client():
-    """Initialize and return Dune client"""
+    """Initialize and return Dune client (shared by all instances, imported lazily)"""
     try:
-        from dune_client.client import DuneClient
-        return DuneClient.from_env()
+        return _cached_dune_client()
     except Exception as e:
         logging.warning(f"Failed to initialize Dune client: {e}")
         return None
 
 
+def create_http_session(pool_connections=4, pool_maxsize=4, headers=None):
+    """Create a requests session with connection pooling and retries"""
+    # Retry connection errors, rate limiting and transient server errors, but hand the final response back to the caller
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip", "User-Agent": "sf-dune-sync"})
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
 def ensure_data_directory():
     """Ensure data directory exists"""
     Path("data").mkdir(exist_ok=True)
 
 
-def get_timestamp():
-    """Get current timestamp string"""
-    return datetime.now().strftime("%Y%m%d_%H%M%S")
+def get_timestamp(now=None):
+    """Get current (or given) timestamp string"""
+    now = now or datetime.now()
+    return f"{now:%Y%m%d_%H%M%S}"
+
+
+def get_date_string(now=None):
+    """Get current (or given) date string for daily data"""
+    now = now or datetime.now()
+    return f"{now:%Y%m%d}"
+
+
+def encode_json(obj):
+    """Encode obj as compact UTF-8 JSON bytes, using orjson if available"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def iter_ndjson(rows):
+    """Yield rows as encoded NDJSON lines, one row at a time"""
+    for row in rows:
+        yield encode_json(row) + b'\n'
+
+
+def parse_json_response(response):
+    """Decode a JSON response body, using orjson if available"""
+    if orjson:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+# Maximum number of response body bytes included in log messages
+LOG_BODY_LIMIT = 2048
+
+
+def response_excerpt(response, limit=LOG_BODY_LIMIT):
+    """Get the start of a response body for log messages, without reading or decoding all of it"""
+    chunk = next(response.iter_content(limit), b'')
+    return chunk[:limit].decode('utf-8', errors='replace')
+
+
+# Request bodies smaller than this are not worth compressing
+GZIP_MIN_BYTES = 2048
+
+
+def gzip_chunks(chunks):
+    """Compress an iterable of byte chunks into a gzip stream"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
 
 
-def get_date_string():
-    """Get current date string for daily data"""
-    return datetime.now().strftime("%Y%m%d")
+def encode_request_body(chunks, content_type):
+    """Prepare a streamed request body, gzip-compressed unless it is smaller than GZIP_MIN_BYTES
+    
+    Returns:
+        tuple: (body, headers) to pass to requests
+    """
+    chunks = iter(chunks)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= GZIP_MIN_BYTES:
+            body = gzip_chunks(itertools.chain(head, chunks))
+            return body, {"Content-Type": content_type, "Content-Encoding": "gzip"}
+    return b''.join(head), {"Content-Type": content_type}
+
+
+# Statuses on which a compressed request body is resent uncompressed, in case the server rejects the encoding
+GZIP_REJECTED_STATUSES = (400, 411, 415)
 
 
 # Dune namespace constant
 DUNE_NAMESPACE = "superfluid_hq"
 
+# Timeout in seconds for requests to the Dune API, same setting and default as DuneClient
+DUNE_API_REQUEST_TIMEOUT = float(os.getenv("DUNE_API_REQUEST_TIMEOUT", "10"))
+
+# Tables known to exist in Dune, shared by all instances in this process
+_existing_tables = set()
+
 class DuneSyncBase:
     """Base class for Dune sync operations"""
     
+    # Connection pool size of the http session, raise in subclasses doing many concurrent requests
+    http_pool_connections = 4
+    http_pool_maxsize = 4
+    
     def __init__(self):
-        self.logger = setup_logging()
-        self.timestamp = get_timestamp()
-        self.date_string = get_date_string()
-        ensure_data_directory()
-        self.dune = get_dune_client()
+        # Logger, clients and data directory are set up lazily on first use (see properties below)
         
         # Daemon control
         self.update_interval = 86400
     
+    @functools.cached_property
+    def logger(self):
+        return setup_logging()
+    
+    @functools.cached_property
+    def timestamp(self):
+        return get_timestamp()
+    
+    @functools.cached_property
+    def date_string(self):
+        return get_date_string()
+    
+    def refresh_timestamp(self):
+        """Update timestamp and date string, called at the start of every sync cycle"""
+        now = datetime.now()
+        self.timestamp = get_timestamp(now)
+        self.date_string = get_date_string(now)
+    
+    @functools.cached_property
+    def data_dir(self):
+        """Local data directory, created on first use"""
+        ensure_data_directory()
+        return Path("data")
+    
+    @functools.cached_property
+    def dune(self):
+        return get_dune_client()
+    
+    # Pooled HTTP sessions, kept alive across calls.
+    # The Dune API key is only set on dune_http so it is never sent to third-party APIs.
+    @functools.cached_property
+    def http(self):
+        return create_http_session(self.http_pool_connections, self.http_pool_maxsize)
+    
+    @functools.cached_property
+    def dune_http(self):
+        return create_http_session(headers={"X-DUNE-API-KEY": get_api_key()})
+    
+    def _post_to_dune(self, url, make_chunks, content_type):
+        """POST a request body to the Dune API, gzip-compressed if large enough (see encode_request_body)
+        
+        make_chunks is called to produce the body's byte chunks, and called again to send the
+        body uncompressed (with a Content-Length) if the compressed request is rejected.
+        """
+        body, headers = encode_request_body(make_chunks(), content_type)
+        response = self.dune_http.post(url, data=body, headers=headers, timeout=DUNE_API_REQUEST_TIMEOUT)
+        
+        if response.status_code in GZIP_REJECTED_STATUSES and "Content-Encoding" in headers:
+            self.logger.warning(f"Compressed request rejected with HTTP {response.status_code} - {response_excerpt(response)}, retrying uncompressed")
+            response.close()
+            response = self.dune_http.post(
+                url, data=b''.join(make_chunks()), headers={"Content-Type": content_type}, timeout=DUNE_API_REQUEST_TIMEOUT
+            )
+        return response
+    
     def upload_csv_to_dune(self, csv_data, table_name, description, is_private=False):
-        """Upload CSV data to Dune (replaces entire table)"""
+        """Upload CSV data to Dune (replaces entire table), gzip-compressed"""
         if not self.dune:
             self.logger.warning("Dune client not available, skipping upload")
             return False
+        
+        # Check API key is set
+        if not get_api_key():
+            self.logger.error("DUNE_API_KEY environment variable not set")
+            return False
             
         try:
-            self.dune.upload_csv(
-                data=csv_data,
-                description=description,
-                table_name=table_name,
-                is_private=is_private
-            )
+            # Same request as DuneClient.upload_csv(), which doesn't allow compressing the body
+            url = "https://api.dune.com/api/v1/table/upload/csv"
+            payload = encode_json({
+                "table_name": table_name,
+                "description": description,
+                "data": csv_data,
+                "is_private": is_private
+            })
+            response = self._post_to_dune(url, lambda: [payload], "application/json")
+            
+            if response.status_code != 200:
+                self.logger.error(f"Upload failed for {table_name}: HTTP {response.status_code} - {response_excerpt(response)}")
+                return False
+            
+            # Like DuneClient.upload_csv(), only report success if Dune does
+            if not parse_json_response(response).get("success"):
+                self.logger.error(f"Upload failed for {table_name}: {response_excerpt(response)}")
+                return False
+            
             self.logger.info(f"Uploaded {table_name} to Dune")
             return True
         except Exception as e:
@@ -85,10 +281,18 @@ class DuneSyncBase:
     def create_table(self, table_name, schema, description="", is_private=False):
         """Create a new table in Dune with defined schema
         
+        Tables created (or found to exist) before are remembered in-process and in a
+        marker file under data/, so their creation isn't requested again.
+        
         Returns:
             dict: API response if table was created successfully
             None: if table already exists or creation failed
         """
+        if table_name in _existing_tables or self._table_marker_path(table_name).exists():
+            _existing_tables.add(table_name)
+            self.logger.info(f"Table {table_name} already exists in Dune (cached)")
+            return None
+        
         if not self.dune:
             self.logger.warning("Dune client not available, skipping table creation")
             return None
@@ -102,6 +306,9 @@ class DuneSyncBase:
                 is_private=is_private
             )
             
+            if result:
+                self._remember_table(table_name)
+            
             # Check if table was newly created or already existed
             if result and not getattr(result, 'already_existed', True):
                 self.logger.info(f"Created new table {table_name} in Dune")
@@ -115,30 +322,45 @@ class DuneSyncBase:
             self.logger.info(f"Table {table_name} creation skipped (likely already exists): {e}")
             return None  # Return None when table already exists
     
+    def _table_marker_path(self, table_name):
+        """Get path of the marker file recording that table_name exists in Dune"""
+        return self.data_dir / f".table_{table_name}_created"
+    
+    def _remember_table(self, table_name):
+        """Record that table_name exists in Dune"""
+        _existing_tables.add(table_name)
+        try:
+            self._table_marker_path(table_name).touch()
+        except OSError as e:
+            self.logger.warning(f"Failed to write table marker for {table_name}: {e}")
+    
+    def forget_table(self, table_name):
+        """Drop the cached knowledge that table_name exists, so create_table asks Dune again"""
+        _existing_tables.discard(table_name)
+        marker_path = self._table_marker_path(table_name)
+        if marker_path.exists():
+            marker_path.unlink()
+    
     def clear_table_data(self, table_name):
         """Clear all data from a Dune table using the API endpoint"""
         try:
-            import requests
-            
-            # Get API key from environment (same way DuneClient.from_env() does)
-            api_key = os.getenv('DUNE_API_KEY')
-            if not api_key:
+            # Check API key is set
+            if not get_api_key():
                 self.logger.error("DUNE_API_KEY environment variable not set")
                 return False
             
             # Make direct API call to clear table
             url = f"https://api.dune.com/api/v1/table/{DUNE_NAMESPACE}/{table_name}/clear"
-            headers = {
-                "X-DUNE-API-KEY": api_key
-            }
             
-            response = requests.post(url, headers=headers)
+            response = self.dune_http.post(url, timeout=DUNE_API_REQUEST_TIMEOUT)
             
             if response.status_code == 200:
                 self.logger.info(f"Successfully cleared data from table {table_name}")
                 return True
             else:
-                self.logger.error(f"Failed to clear table {table_name}: HTTP {response.status_code} - {response.text}")
+                self.logger.error(f"Failed to clear table {table_name}: HTTP {response.status_code} - {response_excerpt(response)}")
+                # The table may have been deleted, don't trust the cached creation anymore
+                self.forget_table(table_name)
                 return False
                 
         except Exception as e:
@@ -147,72 +369,94 @@ class DuneSyncBase:
     
     def insert_data_to_dune(self, table_name, data):
         """Insert data rows into an existing Dune table"""
+        success, _ = self.try_insert_data_to_dune(table_name, data)
+        return success
+    
+    def try_insert_data_to_dune(self, table_name, data):
+        """Insert data rows into an existing Dune table, telling whether a failed insert is worth retrying
+        
+        Returns:
+            tuple: (success, retryable). Failures are retryable unless Dune rejected the request with a
+                client error (4xx other than 429) or the rows couldn't be encoded.
+        """
         if not self.dune:
             self.logger.warning("Dune client not available, skipping data insert")
-            return False
+            return False, True
         
         self.logger.info(f"Inserting {len(data)} rows into {table_name}")
 
+        # Check API key is set
+        if not get_api_key():
+            self.logger.error("DUNE_API_KEY environment variable not set")
+            return False, True
+
         try:
-            # Convert data to NDJSON format (newline-delimited JSON)
-            import json
-            ndjson_content = '\n'.join(json.dumps(row) for row in data)
-            
-            # Create a temporary file with the NDJSON content
-            import tempfile
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.ndjson', delete=False) as temp_file:
-                temp_file.write(ndjson_content)
-                temp_file_path = temp_file.name
-            
-            try:
-                # Upload the file using Dune's insert_table method
-                with open(temp_file_path, 'rb') as f:
-                    result = self.dune.insert_table(
-                        namespace=DUNE_NAMESPACE,
-                        table_name=table_name,
-                        data=f,
-                        content_type='application/x-ndjson'
-                    )
-                
+            # Stream rows as NDJSON (newline-delimited JSON) straight into the (gzipped) request body
+            url = f"https://api.dune.com/api/v1/table/{DUNE_NAMESPACE}/{table_name}/insert"
+            response = self._post_to_dune(url, lambda: iter_ndjson(data), "application/x-ndjson")
+
+            if response.status_code == 200:
                 self.logger.info(f"Successfully inserted {len(data)} rows into {table_name}")
-                return True
-            finally:
-                # Clean up temporary file
-                import os
-                os.unlink(temp_file_path)
-                
+                return True, False
+            else:
+                self.logger.error(f"Data insert failed for {table_name}: HTTP {response.status_code} - {response_excerpt(response)}")
+                return False, response.status_code == 429 or response.status_code >= 500
+
+        except requests.exceptions.RequestException as e:
+            # Connection errors and timeouts
+            self.logger.error(f"Data insert failed for {table_name}: {e}")
+            return False, True
         except Exception as e:
-            import traceback
             self.logger.error(f"Data insert failed for {table_name}: {e}")
             self.logger.error(f"Full traceback: {traceback.format_exc()}")
-            return False
+            return False, False
     
     
     def archive_file(self, file_path):
         """Archive a file with timestamp"""
         try:
-            archive_path = Path(f"data/archive/{Path(file_path).name}_{self.timestamp}")
+            archive_path = self.data_dir / "archive" / f"{Path(file_path).name}_{self.timestamp}"
             archive_path.parent.mkdir(parents=True, exist_ok=True)
-            import shutil
-            shutil.move(str(file_path), str(archive_path))
+            try:
+                # Atomic rename, no data copied (same filesystem)
+                os.replace(file_path, archive_path)
+            except OSError:
+                try:
+                    os.link(file_path, archive_path)
+                    os.unlink(file_path)
+                except OSError:
+                    # Different filesystem, fall back to copy + delete
+                    shutil.move(str(file_path), str(archive_path))
             self.logger.info(f"Archived: {Path(file_path).name}")
             return True
         except Exception as e:
             self.logger.error(f"Failed to archive {file_path}: {e}")
             return False
     
-    def download_table_data(self, table_name):
+    def archive_data(self, data, name):
+        """Archive in-memory data with timestamp as a gzip file, without writing it to data/ first"""
+        try:
+            archive_path = self.data_dir / "archive" / f"{name}_{self.timestamp}.gz"
+            archive_path.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(archive_path, 'wt', newline='') as f:
+                f.write(data)
+            self.logger.info(f"Archived: {name}")
+            return True
+        except Exception as e:
+            self.logger.error(f"Failed to archive {name}: {e}")
+            return False
+    
+    def download_table_data(self, table_name, page_size=10000):
         """Download all data from a Dune table by executing a SQL query
         
+        Results are fetched lazily, page_size rows per request, so only one page is held in memory at a time.
+        
         Returns:
-            list: List of dictionaries representing table rows, or None if failed
+            iterator: Iterator over dictionaries representing table rows, or None if the query failed
         """
         try:
-            import requests
-            
-            # Get API key from environment
-            api_key = os.getenv('DUNE_API_KEY')
-            if not api_key:
+            # Check API key is set
+            if not get_api_key():
                 self.logger.error("DUNE_API_KEY environment variable not set")
                 return None
             
@@ -221,16 +465,15 @@ class DuneSyncBase:
             sql_query = f'SELECT * FROM dune."{DUNE_NAMESPACE}"."{table_name}"'
             
             # Create query via API
-            headers = {"X-DUNE-API-KEY": api_key}
             create_url = "https://api.dune.com/api/v1/query"
             create_data = {
                 "query_sql": sql_query,
                 "name": f"Download {table_name}"
             }
             
-            create_response = requests.post(create_url, json=create_data, headers=headers)
+            create_response = self.dune_http.post(create_url, json=create_data, timeout=DUNE_API_REQUEST_TIMEOUT)
             if create_response.status_code != 200:
-                self.logger.error(f"Failed to create query: HTTP {create_response.status_code} - {create_response.text}")
+                self.logger.error(f"Failed to create query: HTTP {create_response.status_code} - {response_excerpt(create_response)}")
                 return None
             
             query_id = create_response.json()["query_id"]
@@ -238,18 +481,17 @@ class DuneSyncBase:
             
             # Execute query
             execute_url = f"https://api.dune.com/api/v1/query/{query_id}/execute"
-            execute_response = requests.post(execute_url, headers=headers)
+            execute_response = self.dune_http.post(execute_url, timeout=DUNE_API_REQUEST_TIMEOUT)
             if execute_response.status_code != 200:
-                self.logger.error(f"Failed to execute query: HTTP {execute_response.status_code} - {execute_response.text}")
+                self.logger.error(f"Failed to execute query: HTTP {execute_response.status_code} - {response_excerpt(execute_response)}")
                 return None
             
             execution_id = execute_response.json()["execution_id"]
             
             # Wait for query to complete
-            import time
             while True:
                 status_url = f"https://api.dune.com/api/v1/execution/{execution_id}/status"
-                status_response = requests.get(status_url, headers=headers)
+                status_response = self.dune_http.get(status_url, timeout=DUNE_API_REQUEST_TIMEOUT)
                 if status_response.status_code != 200:
                     self.logger.error(f"Failed to get query status: HTTP {status_response.status_code}")
                     return None
@@ -263,22 +505,34 @@ class DuneSyncBase:
                 
                 time.sleep(1)
             
-            # Get results
-            results_url = f"https://api.dune.com/api/v1/execution/{execution_id}/results"
-            results_response = requests.get(results_url, headers=headers)
-            if results_response.status_code != 200:
-                self.logger.error(f"Failed to get query results: HTTP {results_response.status_code}")
-                return None
-            
-            results_data = results_response.json()
-            rows = results_data.get("result", {}).get("rows", [])
-            
-            self.logger.info(f"Downloaded {len(rows)} rows from {table_name}")
-            return rows
+            return self._iter_execution_rows(execution_id, table_name, page_size)
             
         except Exception as e:
-            import traceback
             self.logger.error(f"Failed to download table data from {table_name}: {e}")
             self.logger.error(f"Full traceback: {traceback.format_exc()}")
             return None
-
+    
+    def _iter_execution_rows(self, execution_id, table_name, page_size):
+        """Yield result rows of a completed query execution, one page at a time
+        
+        Raises:
+            RuntimeError: if a results page can't be fetched
+        """
+        results_url = f"https://api.dune.com/api/v1/execution/{execution_id}/results"
+        offset = 0
+        row_count = 0
+        while offset is not None:
+            results_response = self.dune_http.get(
+                results_url, params={"limit": page_size, "offset": offset}, timeout=DUNE_API_REQUEST_TIMEOUT
+            )
+            if results_response.status_code != 200:
+                raise RuntimeError(f"Failed to get query results: HTTP {results_response.status_code}")
+            
+            results_data = results_response.json()
+            rows = results_data.get("result", {}).get("rows", [])
+            row_count += len(rows)
+            yield from rows
+            
+            offset = results_data.get("next_offset")
+        
+        self.logger.info(f"Downloaded {row_count} rows from {table_name}")
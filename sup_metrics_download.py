@@ -8,6 +8,7 @@ Table name is specified by SUP_METRICS_TABLE_NAME environment variable (default:
 
 import os
 import csv
+import itertools
 from dune_utils import DuneSyncBase
 
 def main():
@@ -20,33 +21,49 @@ def main():
     
     # Download table data
     sync.logger.info(f"Downloading data from table: {table_name}")
-    data = sync.download_table_data(table_name)
+    rows = sync.download_table_data(table_name)
     
-    if not data:
+    if rows is None:
         sync.logger.error("Failed to download data")
         return False
     
-    if len(data) == 0:
-        sync.logger.warning("Table is empty, no data to save")
-        return True
-    
     # Determine output filename
     output_file = f"{table_name}.csv"
     
-    # Write data to CSV
+    # Write rows to CSV as they are downloaded
     try:
-        with open(output_file, 'w', newline='') as f:
-            if data:
-                fieldnames = data[0].keys()
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(data)
+        first_row = next(rows, None)
+        if first_row is None:
+            sync.logger.warning("Table is empty, no data to save")
+            return True
+        
+        columns = list(first_row.keys())
+        row_count = 0
+        
+        def positional_rows():
+            nonlocal row_count
+            for row in itertools.chain([first_row], rows):
+                row_count += 1
+                yield [row.get(column) for column in columns]
+        
+        # Write to a temporary file first, so a download failing midway doesn't leave a truncated CSV
+        tmp_file = f"{output_file}.tmp"
+        try:
+            with open(tmp_file, 'w', newline='', buffering=1 << 20) as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(positional_rows())
+            os.replace(tmp_file, output_file)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
         
-        sync.logger.info(f"Successfully saved {len(data)} rows to {output_file}")
+        sync.logger.info(f"Successfully saved {row_count} rows to {output_file}")
         return True
         
     except Exception as e:
-        sync.logger.error(f"Failed to write CSV file: {e}")
+        sync.logger.error(f"Failed to download or write CSV file: {e}")
         return False
 
 if __name__ == "__main__":
@@ -10,9 +10,55 @@ Table: dune.superfluid_hq.sup_metrics_history (or as specified by TABLE_NAME env
 import requests
 import time
 import csv
+import json
 import os
+import signal
+import threading
 from pathlib import Path
-from dune_utils import DuneSyncBase
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dune_utils import DuneSyncBase, iter_ndjson, parse_json_response, response_excerpt
+
+# Use pyarrow to parse the preset CSV if installed
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None  # pyarrow not available, parse the preset CSV row by row
+
+# Table columns and the API metrics they are filled from, in table column order
+FIELD_MAP = (
+    ('reserves', 'reserveBalances'),
+    ('lockers', 'lockerBalances'),
+    ('staked', 'stakedSup'),
+    ('lp', 'lpSup'),
+    ('lp_provided', 'lpSupProvided'),
+    ('lp_collected', 'lpSupCollected'),
+    ('fontaines', 'streamingOut'),
+    ('community_charge', 'communityCharge'),
+    ('investors_team_locked', 'investorsTeamLocked'),
+    ('dao_treasury', 'daoTreasury'),
+    ('dao_treasury_unlocked', 'daoTreasuryUnlocked'),
+    ('dao_treasury_locked', 'daoTreasurylocked'),
+    ('dao_spr_manager', 'daoSPRProgramManager'),
+    ('foundation_treasury', 'foundationTreasury'),
+    ('vesting_treasury', 'vestingTreasury'),
+    ('sup_corp_ops', 'supCorpOps'),
+    ('other', 'other'),
+    ('total_supply', 'totalSupply'),
+)
+
+# Table schema for SUP metrics (shared, don't mutate)
+TABLE_SCHEMA = (
+    {"name": "timestamp", "type": "timestamp", "nullable": False},
+    *({"name": col, "type": "bigint", "nullable": True} for col, _ in FIELD_MAP),
+)
+
+# Flush pending rows once this many have accumulated, regardless of the batch interval
+BATCH_SIZE = 32
+
+# Most rows kept pending while inserts keep failing (a year of daily rows), older rows are moved to the rejected file
+MAX_PENDING_ROWS = 366
 
 class SupMetricsSync(DuneSyncBase):
     """SUP Distribution Metrics Sync"""
@@ -22,17 +68,88 @@ class SupMetricsSync(DuneSyncBase):
         # Hardcode the update interval to 1 day
         self.update_interval = 86400
         self.api_url = "https://sup-metrics-api.superfluid.dev/v1/distribution_metrics"
+        # Minimum seconds between inserts; rows are queued locally in between (default: insert every cycle)
+        self.batch_interval = int(os.getenv("SUP_METRICS_BATCH_INTERVAL", 0))
+        # Rows not yet inserted into Dune, loaded from disk on first use
+        self.pending_rows = None
+        self.last_flush = None
+        # Set (e.g. by SIGHUP) to wake the daemon and flush pending rows early
+        self.flush_requested = threading.Event()
+        # Validators of the last metrics response, loaded from disk on first use, see fetch_metrics
+        self._metrics_etag = None
+        self._metrics_last_mod = None
+        self._metrics_state_loaded = False
+    
+    def _metrics_state_path(self):
+        """Get path of the file holding the last metrics response and its validators"""
+        return self.data_dir / "sup_metrics_state.json"
+    
+    def _load_metrics_state(self):
+        """Load validators of the last metrics response persisted by a previous cycle"""
+        self._metrics_state_loaded = True
+        state_path = self._metrics_state_path()
+        if not state_path.exists():
+            return
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            self._metrics_etag = state.get("etag")
+            self._metrics_last_mod = state.get("last_modified")
+        except Exception as e:
+            self.logger.error(f"Failed to load metrics state from {state_path}: {e}")
+    
+    def _save_metrics_state(self, data):
+        """Persist the metrics response and its validators"""
+        state_path = self._metrics_state_path()
+        try:
+            tmp_path = state_path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({"etag": self._metrics_etag, "last_modified": self._metrics_last_mod, "metrics": data}, f)
+            os.replace(tmp_path, state_path)
+        except Exception as e:
+            self.logger.error(f"Failed to save metrics state to {state_path}: {e}")
+    
+    def _cached_metrics(self):
+        """Get the metrics persisted with the last 200 response"""
+        try:
+            with open(self._metrics_state_path(), 'r') as f:
+                return json.load(f).get("metrics")
+        except Exception as e:
+            self.logger.error(f"Failed to load cached metrics: {e}")
+            return None
     
     def fetch_metrics(self):
-        """Fetch SUP distribution metrics from API"""
+        """Fetch SUP distribution metrics from API (conditional request, unchanged metrics are read from disk)"""
+        if not self._metrics_state_loaded:
+            self._load_metrics_state()
+        
+        headers = {}
+        if self._metrics_etag:
+            headers["If-None-Match"] = self._metrics_etag
+        if self._metrics_last_mod:
+            headers["If-Modified-Since"] = self._metrics_last_mod
+        
         try:
-            response = requests.get(self.api_url, timeout=30)
+            response = self.http.get(self.api_url, headers=headers, timeout=30)
+            
+            if response.status_code == 304:
+                self.logger.info("Metrics not modified since last fetch, using cached metrics")
+                data = self._cached_metrics()
+                if data is not None:
+                    return data
+                # Cache is gone, fetch unconditionally
+                self._metrics_etag = self._metrics_last_mod = None
+                response = self.http.get(self.api_url, timeout=30)
             
             if response.status_code != 200:
-                self.logger.error(f"HTTP {response.status_code}: {response.text}")
+                self.logger.error(f"HTTP {response.status_code}: {response_excerpt(response)}")
                 return None
             
-            data = response.json()
+            data = parse_json_response(response)
+            self._metrics_etag = response.headers.get("ETag")
+            self._metrics_last_mod = response.headers.get("Last-Modified")
+            if self._metrics_etag or self._metrics_last_mod:
+                self._save_metrics_state(data)
             return data
         except requests.exceptions.RequestException as e:
             self.logger.error(f"API request failed: {e}")
@@ -43,29 +160,8 @@ class SupMetricsSync(DuneSyncBase):
     
     
     def get_table_schema(self):
-        """Create table schema for SUP metrics"""
-        schema = [
-            {"name": "timestamp", "type": "timestamp", "nullable": False},
-            {"name": "reserves", "type": "bigint", "nullable": True},
-            {"name": "lockers", "type": "bigint", "nullable": True},
-            {"name": "staked", "type": "bigint", "nullable": True},
-            {"name": "lp", "type": "bigint", "nullable": True},
-            {"name": "lp_provided", "type": "bigint", "nullable": True},
-            {"name": "lp_collected", "type": "bigint", "nullable": True},
-            {"name": "fontaines", "type": "bigint", "nullable": True},
-            {"name": "community_charge", "type": "bigint", "nullable": True},
-            {"name": "investors_team_locked", "type": "bigint", "nullable": True},
-            {"name": "dao_treasury", "type": "bigint", "nullable": True},
-            {"name": "dao_treasury_unlocked", "type": "bigint", "nullable": True},
-            {"name": "dao_treasury_locked", "type": "bigint", "nullable": True},
-            {"name": "dao_spr_manager", "type": "bigint", "nullable": True},
-            {"name": "foundation_treasury", "type": "bigint", "nullable": True},
-            {"name": "vesting_treasury", "type": "bigint", "nullable": True},
-            {"name": "sup_corp_ops", "type": "bigint", "nullable": True},
-            {"name": "other", "type": "bigint", "nullable": True},
-            {"name": "total_supply", "type": "bigint", "nullable": True},
-        ]
-        return schema
+        """Get table schema for SUP metrics"""
+        return TABLE_SCHEMA
     
     def validate_csv_structure(self, csv_file_path, expected_schema):
         """Validate that CSV structure matches expected schema"""
@@ -89,6 +185,11 @@ class SupMetricsSync(DuneSyncBase):
     
     def load_preset_csv_data(self, csv_file_path):
         """Load and parse CSV data from preset file"""
+        if pyarrow:
+            preset_data = self._load_preset_csv_data_pyarrow(csv_file_path)
+            if preset_data is not None:
+                return preset_data
+        
         try:
             preset_data = []
             with open(csv_file_path, 'r') as f:
@@ -111,6 +212,27 @@ class SupMetricsSync(DuneSyncBase):
             self.logger.error(f"Failed to load preset CSV data: {e}")
             return None
     
+    def _load_preset_csv_data_pyarrow(self, csv_file_path):
+        """Load preset CSV data with pyarrow's column-wise parser, same types as load_preset_csv_data"""
+        try:
+            with open(csv_file_path, 'r') as f:
+                columns = next(csv.reader(f), [])
+            # Keep timestamps as they are, all other columns are integers (empty cells become None)
+            column_types = {
+                col: pyarrow.string() if col == 'timestamp' else pyarrow.int64()
+                for col in columns
+            }
+            table = pyarrow.csv.read_csv(
+                csv_file_path,
+                convert_options=pyarrow.csv.ConvertOptions(column_types=column_types)
+            )
+            preset_data = table.to_pylist()
+            self.logger.info(f"Loaded {len(preset_data)} rows from preset CSV file")
+            return preset_data
+        except Exception as e:
+            self.logger.warning(f"Failed to load preset CSV data with pyarrow, retrying without: {e}")
+            return None
+    
     def process_metrics(self):
         """Process and upload metrics data using Dune's programmatic table management"""
         self.logger.info(f"Starting SUP metrics sync at {self.timestamp}")
@@ -130,22 +252,35 @@ class SupMetricsSync(DuneSyncBase):
         """Initialize table: create, clear, and load preset data"""
         self.logger.info("SUP_METRICS_INIT is set, initializing table")
         
-        # Create table (allow failure if exists)
-        schema = self.get_table_schema()
-        self.create_table(
-            table_name=table_name,
-            schema=schema,
-            description="SUP distribution metrics historical data",
-            is_private=False
-        )
-        
-        # Clear table data
-        if not self.clear_table_data(table_name):
-            self.logger.error("Failed to clear table data, aborting sync")
-            return False
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Read preset data in the background while waiting for the Dune API
+            preset_future = executor.submit(self._read_preset_data)
+            
+            schema = self.get_table_schema()
+            for attempt in range(2):
+                # Create table (allow failure if exists)
+                self.create_table(
+                    table_name=table_name,
+                    schema=schema,
+                    description="SUP distribution metrics historical data",
+                    is_private=False
+                )
+                
+                # Clear table data
+                if self.clear_table_data(table_name):
+                    break
+                # A table cached as created may have been deleted in Dune. clear_table_data dropped
+                # it from the cache, so the next attempt requests its creation again.
+                if attempt == 0:
+                    self.logger.warning("Failed to clear table data, creating table again and retrying")
+            else:
+                self.logger.error("Failed to clear table data, aborting sync")
+                return False
+            
+            preset_data = preset_future.result()
         
         # Load preset data
-        return self._load_preset_data(table_name)
+        return self._load_preset_data(table_name, preset_data)
     
     def _add_latest_entry(self, table_name):
         """Add latest metrics entry to existing table"""
@@ -166,21 +301,31 @@ class SupMetricsSync(DuneSyncBase):
         
         return success
     
-    def _load_preset_data(self, table_name):
-        """Load and insert preset CSV data if file exists"""
+    def _read_preset_data(self):
+        """Read preset CSV data
+        
+        Returns:
+            list: Preset rows (empty if there is no preset file), or None if loading failed
+        """
         preset_csv_path = Path("sup_metrics_preset.csv")
         
         if not preset_csv_path.exists():
             self.logger.info("No preset CSV file found")
-            return True
+            return []
         
         self.logger.info(f"Preset CSV file found: {preset_csv_path}")
         
-        preset_data = self.load_preset_csv_data(preset_csv_path)
-        if not preset_data:
+        return self.load_preset_csv_data(preset_csv_path)
+    
+    def _load_preset_data(self, table_name, preset_data):
+        """Insert preset data read by _read_preset_data"""
+        if preset_data is None:
             self.logger.error("Failed to load preset data")
             return False
         
+        if not preset_data:
+            return True
+        
         self.logger.info(f"Inserting {len(preset_data)} preset rows into table")
         preset_success = self.insert_data_to_dune(table_name, preset_data)
         if preset_success:
@@ -192,45 +337,141 @@ class SupMetricsSync(DuneSyncBase):
     
     def _insert_current_data(self, table_name, metrics):
         """Insert current metrics data"""
-        from datetime import datetime
         current_timestamp = datetime.now().isoformat()
 
-        new_row = {
-            'timestamp': current_timestamp,
-            'reserves': metrics.get('reserveBalances'),
-            'lockers': metrics.get('lockerBalances'),
-            'staked': metrics.get('stakedSup'),
-            'lp': metrics.get('lpSup'),
-            'lp_provided': metrics.get('lpSupProvided'),
-            'lp_collected': metrics.get('lpSupCollected'),
-            'fontaines': metrics.get('streamingOut'),
-            'community_charge': metrics.get('communityCharge'),
-            'investors_team_locked': metrics.get('investorsTeamLocked'),
-            'dao_treasury': metrics.get('daoTreasury'),
-            'dao_treasury_unlocked': metrics.get('daoTreasuryUnlocked'),
-            'dao_treasury_locked': metrics.get('daoTreasurylocked'),
-            'dao_spr_manager': metrics.get('daoSPRProgramManager'),
-            'foundation_treasury': metrics.get('foundationTreasury'),
-            'vesting_treasury': metrics.get('vestingTreasury'),
-            'sup_corp_ops': metrics.get('supCorpOps'),
-            'other': metrics.get('other'),
-            'total_supply': metrics.get('totalSupply'),
-        }
+        new_row = {'timestamp': current_timestamp, **{col: metrics.get(src) for col, src in FIELD_MAP}}
+        
+        if self.pending_rows is None:
+            self.pending_rows = self.load_pending_rows(table_name)
+        self.pending_rows.append(new_row)
+        if len(self.pending_rows) > MAX_PENDING_ROWS:
+            overflow = len(self.pending_rows) - MAX_PENDING_ROWS
+            self.logger.warning(f"More than {MAX_PENDING_ROWS} rows pending, giving up on the {overflow} oldest")
+            self.reject_rows(table_name, self.pending_rows[:overflow])
+            del self.pending_rows[:overflow]
+        self.save_pending_rows(table_name)
+        
+        if not self._flush_due():
+            self.logger.info(f"Queued data for {self.date_string} ({len(self.pending_rows)} rows pending)")
+            return True
+        
+        return self.flush_pending_rows(table_name)
+    
+    def _flush_due(self):
+        """Check whether pending rows should be inserted now"""
+        if len(self.pending_rows) >= BATCH_SIZE or self.last_flush is None:
+            return True
+        return time.monotonic() - self.last_flush >= self.batch_interval
+    
+    def _pending_rows_path(self, table_name):
+        """Get path of the file holding rows not yet inserted into table_name"""
+        return self.data_dir / f"{table_name}_pending.ndjson"
+    
+    def load_pending_rows(self, table_name):
+        """Load rows left pending by previous cycles"""
+        pending_path = self._pending_rows_path(table_name)
+        if not pending_path.exists():
+            return []
+        
+        try:
+            with open(pending_path, 'r') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            self.logger.info(f"Loaded {len(rows)} pending rows from {pending_path}")
+            return rows
+        except Exception as e:
+            self.logger.error(f"Failed to load pending rows from {pending_path}: {e}")
+            return []
+    
+    def _rejected_rows_path(self, table_name):
+        """Get path of the file collecting rows which won't be inserted into table_name"""
+        return self.data_dir / f"{table_name}_rejected.ndjson"
+    
+    def reject_rows(self, table_name, rows):
+        """Set rows aside in the rejected file (for manual inspection) instead of retrying them"""
+        rejected_path = self._rejected_rows_path(table_name)
+        for row in rows:
+            self.logger.error(f"Not inserting row: {row}")
+        try:
+            with open(rejected_path, 'ab') as f:
+                f.writelines(iter_ndjson(rows))
+            self.logger.info(f"Moved {len(rows)} rows to {rejected_path}")
+        except Exception as e:
+            self.logger.error(f"Failed to save rejected rows to {rejected_path}: {e}")
+    
+    def save_pending_rows(self, table_name):
+        """Persist pending rows so they survive a restart"""
+        pending_path = self._pending_rows_path(table_name)
+        try:
+            if not self.pending_rows:
+                if pending_path.exists():
+                    pending_path.unlink()
+                return
+            
+            tmp_path = pending_path.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.writelines(iter_ndjson(self.pending_rows))
+            os.replace(tmp_path, pending_path)
+        except Exception as e:
+            self.logger.error(f"Failed to save pending rows to {pending_path}: {e}")
+    
+    def flush_pending_rows(self, table_name):
+        """Insert all pending rows in a single request"""
+        if self.pending_rows is None:
+            self.pending_rows = self.load_pending_rows(table_name)
+        if not self.pending_rows:
+            self.logger.info("No pending rows to insert")
+            return True
         
+        row_count = len(self.pending_rows)
         try:
-            success = self.insert_data_to_dune(table_name, [new_row])
+            success, retryable = self.try_insert_data_to_dune(table_name, self.pending_rows)
+            if not success and not retryable and len(self.pending_rows) > 1:
+                # Dune rejected the batch, insert rows one by one to set aside only the rejected ones
+                success, retryable = self._insert_rows_individually(table_name)
+            
             if success:
-                self.logger.info(f"Successfully inserted data for {self.date_string}")
+                self.logger.info(f"Finished inserting data for {self.date_string} ({row_count} rows)")
+                self.pending_rows = []
+                self.last_flush = time.monotonic()
+                self.save_pending_rows(table_name)
                 return True
+            elif retryable:
+                self.logger.error(f"Failed to insert data, keeping {len(self.pending_rows)} rows pending")
+                self.save_pending_rows(table_name)
+                return False
             else:
-                self.logger.error("Failed to insert data")
+                self.logger.error(f"Dune rejected {len(self.pending_rows)} rows, not retrying them")
+                self.reject_rows(table_name, self.pending_rows)
+                self.pending_rows = []
+                self.save_pending_rows(table_name)
                 return False
         except Exception as e:
             self.logger.error(f"Insert process failed: {e}")
             return False
     
+    def _insert_rows_individually(self, table_name):
+        """Insert pending rows one at a time, setting aside rows Dune rejects
+        
+        Rows failing for a retryable reason are kept pending.
+        
+        Returns:
+            tuple: (success, retryable) for the rows still pending afterwards
+        """
+        kept = []
+        for row in self.pending_rows:
+            success, retryable = self.try_insert_data_to_dune(table_name, [row])
+            if success:
+                continue
+            if retryable:
+                kept.append(row)
+            else:
+                self.reject_rows(table_name, [row])
+        self.pending_rows = kept
+        return not kept, True
+    
     def sync_once(self):
         """Execute a single sync cycle"""
+        self.refresh_timestamp()
         self.logger.info(f"Starting SUP metrics sync cycle at {self.timestamp}")
         
         success = self.process_metrics()
@@ -248,11 +489,23 @@ class SupMetricsSync(DuneSyncBase):
         self.logger.info(f"Update interval: {self.update_interval} seconds ({self.update_interval // 3600} hours)")
         self.logger.info("Press Ctrl+C to stop")
         
+        if hasattr(signal, "SIGHUP"):
+            # Event.set() takes a lock the main thread may be holding (in wait() or clear()) when the
+            # signal handler runs, so set the event from another thread
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self.flush_requested.set).start())
+            self.logger.info("Send SIGHUP to insert pending rows immediately")
+        
         try:
+            # Schedule cycles against a monotonic deadline so the time spent syncing doesn't add up to drift
+            next_deadline = time.monotonic()
             while True:
                 self.sync_once()
-                self.logger.info(f"Waiting {self.update_interval} seconds until next sync...")
-                time.sleep(self.update_interval)
+                next_deadline += self.update_interval
+                self.logger.info(f"Waiting {max(0, next_deadline - time.monotonic()):.0f} seconds until next sync...")
+                while self.flush_requested.wait(timeout=max(0, next_deadline - time.monotonic())):
+                    self.flush_requested.clear()
+                    self.logger.info("Flush requested, inserting pending rows")
+                    self.flush_pending_rows(os.getenv("SUP_METRICS_TABLE_NAME", "sup_metrics_history"))
         except KeyboardInterrupt:
             self.logger.info("Received keyboard interrupt, shutting down...")
         except Exception as e:
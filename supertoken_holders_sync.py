@@ -6,53 +6,145 @@ Fetches SuperToken holders from all mainnet Superfluid networks and uploads to D
 Runs continuously with configurable update intervals.
 """
 
+import argparse
 import csv
+import io
+import itertools
+import json
 import os
 import requests
 import time
-from pathlib import Path
-from dune_utils import DuneSyncBase
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dune_utils import DuneSyncBase, encode_json, parse_json_response, response_excerpt
+
+# Use ijson to stream holders from the API response if installed
+try:
+    import ijson
+except ImportError:
+    ijson = None  # ijson not available, parse the whole response at once
 
 API_BASE = "https://supertoken-api.s.superfluid.dev/v0"
 
+NETWORKS_URL = "https://raw.githubusercontent.com/superfluid-org/protocol-monorepo/refs/heads/dev/packages/metadata/networks.json"
+
+# Seconds the networks list is cached before it is fetched again
+NETWORKS_CACHE_TTL = 86400
+
+# Seconds a network's token list is cached before the subgraph is queried again
+TOKENS_CACHE_TTL = 3600
+
+# Subgraph query for the listed SuperTokens of a network, encoded once as request body for get_tokens.
+# TODO: this assumes there's not more than 1000 listed tokens. Needs pagination at some point.
+_TOKENS_QUERY = {"query": "query { tokens(first: 1000, where: {isListed: true}) { id symbol name } }"}
+_TOKENS_QUERY_BODY = encode_json(_TOKENS_QUERY)
+
+# Tokens of a chain not found by the holders API within a cycle, after which its cached token list is dropped
+STALE_TOKENS_THRESHOLD = 3
+
+# Token bucket rate limit per API host: sustained requests per second and burst size
+RATE_LIMIT_PER_SECOND = 5
+RATE_LIMIT_BURST = 10
+
+# Tokens without holders are not queried again for this long (seconds), see process_token
+EMPTY_TOKENS_TTL = 7 * 86400
+
+# Number of concurrent Dune uploads, and CSVs that may wait for an upload worker
+UPLOAD_WORKERS = 4
+UPLOAD_QUEUE_LIMIT = 8
+
+HOLDERS_CSV_HEADER = ('address', 'balance', 'net_flowrate')
+
 class SuperTokenSync(DuneSyncBase):
+    # Many requests to a few hosts (metadata, subgraphs, supertoken-api), keep plenty of connections alive
+    http_pool_connections = 32
+    http_pool_maxsize = 64
+    
     def __init__(self):
         super().__init__()
         # Override default update interval with SUPERTOKEN_HOLDERS_UPDATE_INTERVAL if set
         self.update_interval = int(os.getenv("SUPERTOKEN_HOLDERS_UPDATE_INTERVAL", self.update_interval))
+        # Number of tokens processed concurrently
+        self.concurrency = int(os.getenv("SUPERTOKEN_HOLDERS_CONCURRENCY", 4))
+        # Networks metadata cache, see get_networks
+        self._networks_cache = None
+        self._networks_cache_ts = 0
+        self._networks_etag = None
+        # Token lists by subgraph endpoint: (tokens, fetched at, chainId), see get_tokens
+        self._tokens_cache = {}
+        # Tokens not found by the holders API in the current cycle, by chainId
+        self._not_found_counts = {}
+        # Tokens without holders: "chainId:address" -> unix time of the check, see process_token.
+        # Loaded from data/empty_tokens.json on first use, saved by sync_once.
+        self._empty_tokens = None
+        self._empty_tokens_changed = False
+        # Rate limit token buckets by host: (tokens, last refill), see _wait_for_rate_limit
+        self._buckets = {}
+        self._lock = threading.Lock()
+        # Limits CSVs held in memory while waiting for upload, see process_token
+        self._upload_slots = threading.Semaphore(UPLOAD_WORKERS + UPLOAD_QUEUE_LIMIT)
+        # Futures of tokens being processed by (address, chainId), see process_token
+        self._inflight = {}
 
     def get_networks(self):
-        """Get all mainnet networks from Superfluid metadata"""
+        """Get all mainnet networks from Superfluid metadata (cached for NETWORKS_CACHE_TTL)"""
+        if self._networks_cache is not None and time.monotonic() - self._networks_cache_ts < NETWORKS_CACHE_TTL:
+            return self._networks_cache
+        
         try:
-            response = requests.get("https://raw.githubusercontent.com/superfluid-org/protocol-monorepo/refs/heads/dev/packages/metadata/networks.json")
-            networks = response.json()
-            return [net for net in networks if not net.get("isTestnet", True)]
+            # Revalidate a cached list with its ETag, the server answers 304 if it didn't change
+            headers = {"If-None-Match": self._networks_etag} if self._networks_cache is not None and self._networks_etag else {}
+            response = self.http.get(NETWORKS_URL, headers=headers, timeout=30)
+            if response.status_code == 304:
+                self._networks_cache_ts = time.monotonic()
+                return self._networks_cache
+            
+            networks = parse_json_response(response)
+            mainnets = [net for net in networks if not net.get("isTestnet", True)]
+            self._networks_cache = mainnets
+            self._networks_cache_ts = time.monotonic()
+            self._networks_etag = response.headers.get("ETag")
+            return mainnets
         except:
             self.logger.error("Failed to fetch networks")
+            if self._networks_cache is not None:
+                self.logger.info("Using previously fetched networks")
+                return self._networks_cache
             return []
 
+    def _subgraph_endpoint(self, network):
+        """Get the protocol subgraph endpoint of a network"""
+        return network.get("subgraphV1", {}).get("hostedEndpoint")
+
     def get_tokens(self, network):
-        """Get SuperTokens from subgraph"""
+        """Get SuperTokens from subgraph (cached per endpoint for TOKENS_CACHE_TTL)"""
         try:
             endpoint = network["subgraphV1"]["hostedEndpoint"]
             
-            # TODO: this assumes there's not more than 1000 listed tokens. Needs pagination at some point.
-            query = """
-            query { tokens(first: 1000, where: {isListed: true}) { id symbol name } }
-            """
+            with self._lock:
+                cached = self._tokens_cache.get(endpoint)
+            if cached and time.monotonic() - cached[1] < TOKENS_CACHE_TTL:
+                return cached[0]
             
-            response = requests.post(endpoint, json={"query": query}, timeout=30)
+            response = self.http.post(
+                endpoint, data=_TOKENS_QUERY_BODY, headers={"Content-Type": "application/json"}, timeout=30
+            )
             
             if response.status_code != 200:
-                self.logger.error(f"    Subgraph HTTP {response.status_code}: {response.text}")
+                self.logger.error(f"    Subgraph HTTP {response.status_code}: {response_excerpt(response)}")
                 return []
             
-            data = response.json()
+            data = parse_json_response(response)
             if "errors" in data:
                 self.logger.error(f"    Subgraph errors: {data['errors']}")
                 return []
             
-            return data["data"]["tokens"]
+            tokens = data["data"]["tokens"]
+            # Token workers may be dropping cached lists concurrently, see _token_not_found
+            with self._lock:
+                self._tokens_cache[endpoint] = (tokens, time.monotonic(), network["chainId"])
+            return tokens
         except requests.exceptions.RequestException as e:
             self.logger.error(f"    Subgraph request failed: {e}")
             return []
@@ -61,25 +153,43 @@ class SuperTokenSync(DuneSyncBase):
             return []
 
     def get_holders(self, token_address, chain_id):
-        """Get holders from API"""
+        """Get holders from API
+        
+        Returns:
+            iterator: Iterator over holder dicts (streamed from the response if ijson is installed),
+                or None if the request failed
+        """
         try:
             url = f"{API_BASE}/tokens/{token_address}/holders"
-            response = requests.get(url, params={"chainId": chain_id, "limit": 1000000}, timeout=30)
+            self._wait_for_rate_limit(urlparse(url).netloc)
+            response = self.http.get(url, params={"chainId": chain_id, "limit": 1000000}, timeout=30, stream=True)
             
             # Check HTTP status code
             if response.status_code == 404:
                 self.logger.warning(f"    Token not found (404) for {token_address}")
+                response.close()
+                self._token_not_found(chain_id)
                 return None
             elif response.status_code != 200:
-                self.logger.warning(f"    HTTP {response.status_code} for {token_address}: {response.text}")
+                self.logger.warning(f"    HTTP {response.status_code} for {token_address}: {response_excerpt(response)}")
+                response.close()
                 return None
             
-            data = response.json()
+            if ijson:
+                return self._stream_holders(response, token_address)
+            
+            data = parse_json_response(response)
             if "error" in data:
                 self.logger.warning(f"    API error for {token_address}: {data['error']}")
                 return None
             
-            return data
+            holders = data.get("holders")
+            if not isinstance(holders, list):
+                # No holders array, don't take this as the token having no holders
+                self.logger.warning(f"    No holders list in API response for {token_address}")
+                return None
+            
+            return iter(holders)
         except requests.exceptions.RequestException as e:
             self.logger.warning(f"    API request failed for {token_address}: {e}")
             return None
@@ -87,8 +197,117 @@ class SuperTokenSync(DuneSyncBase):
             self.logger.warning(f"    Unexpected error getting holders for {token_address}: {e}")
             return None
 
-    def process_token(self, token, network):
-        """Process a single token"""
+    def _stream_holders(self, response, token_address):
+        """Stream holders from the response while it is being received
+        
+        The response is read up to the start of the holders array before returning, so an API error is detected.
+        
+        Returns:
+            iterator: Iterator over holder dicts, or None if the API returned an error or no holders array
+        """
+        try:
+            response.raw.decode_content = True
+            events = ijson.parse(response.raw)
+            for prefix, event, value in events:
+                if prefix == "" and event == "map_key":
+                    if value == "error":
+                        error = next(ijson.items(events, "error"), None)
+                        self.logger.warning(f"    API error for {token_address}: {error}")
+                        response.close()
+                        return None
+                    if value == "holders":
+                        if next(events)[1] == "start_array":
+                            return self._iter_holders(response, events)
+                        break
+        except Exception:
+            response.close()
+            raise
+        
+        # No holders array, don't take this as the token having no holders
+        self.logger.warning(f"    No holders list in API response for {token_address}")
+        response.close()
+        return None
+
+    def _iter_holders(self, response, events):
+        """Yield holders one by one from the parser events following the holders key"""
+        with response:
+            yield from ijson.items(events, "holders.item")
+
+    def _stream_holders_to_csv(self, token_address, chain_id, writer):
+        """Write a token's holders to a CSV writer as they are received
+        
+        Returns:
+            int: Number of holders written, or None if getting the holders failed
+        """
+        holders = self.get_holders(token_address, chain_id)
+        if holders is None:
+            return None
+        
+        holder_count = 0
+        
+        def holder_rows():
+            nonlocal holder_count
+            for holder in holders:
+                holder_count += 1
+                yield (holder.get('address', ''), holder.get('balance', ''), holder.get('netFlowRate', ''))
+        
+        writer.writerows(holder_rows())
+        return holder_count
+
+    def _wait_for_rate_limit(self, host):
+        """Wait until the token bucket of host allows another request"""
+        with self._lock:
+            now = time.monotonic()
+            tokens, last_refill = self._buckets.get(host, (RATE_LIMIT_BURST, now))
+            tokens = min(RATE_LIMIT_BURST, tokens + (now - last_refill) * RATE_LIMIT_PER_SECOND)
+            # Take the token right away; a negative balance queues up concurrent callers
+            tokens -= 1
+            self._buckets[host] = (tokens, now)
+        if tokens < 0:
+            time.sleep(-tokens / RATE_LIMIT_PER_SECOND)
+
+    def _token_not_found(self, chain_id):
+        """Count a missing token, dropping cached token lists of the chain if that happens repeatedly"""
+        with self._lock:
+            self._not_found_counts[chain_id] = self._not_found_counts.get(chain_id, 0) + 1
+            if self._not_found_counts[chain_id] != STALE_TOKENS_THRESHOLD:
+                return
+            stale_endpoints = [endpoint for endpoint, cached in self._tokens_cache.items() if cached[2] == chain_id]
+            for endpoint in stale_endpoints:
+                del self._tokens_cache[endpoint]
+        if stale_endpoints:
+            self.logger.info(f"    Repeated 404s on chainId {chain_id}, dropping cached token list")
+
+    def process_token(self, token, network, upload_executor=None):
+        """Process a single token
+        
+        If upload_executor is given, the upload is handed to it and its future returned,
+        otherwise the upload happens before returning.
+        """
+        # A token already being processed (e.g. listed twice for a chain) isn't fetched again,
+        # concurrent callers wait for and share the result of the call in flight
+        key = ((token.get("id") or "").lower(), network["chainId"])
+        with self._lock:
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                future = self._inflight[key] = Future()
+        if inflight is not None:
+            self.logger.info(f"  {token.get('symbol')} ({key[0]}) is already being processed, waiting for it")
+            return inflight.result()
+        
+        try:
+            result = self._process_token(token, network, upload_executor)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _process_token(self, token, network, upload_executor):
+        """Process a single token, see process_token"""
         # Validate token data
         if not token.get("id"):
             self.logger.warning(f"  Skipping token with missing address: {token}")
@@ -105,44 +324,64 @@ class SuperTokenSync(DuneSyncBase):
         chain_id = network["chainId"]
         dune_name = network.get("duneName", f"chain_{chain_id}")
         
-        self.logger.info(f"  Processing {token_symbol} ({token_address}) on {network['name']}")
-        
-        # Get holders
-        holders_data = self.get_holders(token_address, chain_id)
-        if holders_data is None:
-            self.logger.warning(f"    Failed to get holders data for {token_symbol} - skipping")
+        # Skip tokens which had no holders when last checked, they are rechecked after EMPTY_TOKENS_TTL
+        empty_key = f"{chain_id}:{token_address.lower()}"
+        checked_at = self._empty_token_checked_at(empty_key)
+        if checked_at and time.time() - checked_at < EMPTY_TOKENS_TTL:
+            self.logger.debug(f"  Skipping {token_symbol} ({token_address}) - no holders at last check")
             return
         
-        if not holders_data.get("holders"):
-            self.logger.info(f"    No holders for {token_symbol}")
-            return
+        self.logger.info(f"  Processing {token_symbol} ({token_address}) on {network['name']}")
         
-        holders = holders_data["holders"]
-        self.logger.info(f"    Found {len(holders)} holders for {token_symbol}")
+        table_name = f"{dune_name}_{token_symbol.lower()}_holders"
+        csv_name = f"{table_name}.csv"
         
-        # Create CSV
+        # Create CSV in memory, writing holders as they are received
         try:
-            csv_path = Path(f"data/{dune_name}_{token_symbol.lower()}_holders.csv")
-            with open(csv_path, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(['address', 'balance', 'net_flowrate'])
-                for holder in holders:
-                    writer.writerow([holder.get('address', ''), holder.get('balance', ''), holder.get('netFlowRate', '')])
-            
-            self.logger.info(f"    Created CSV: {csv_path}")
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(HOLDERS_CSV_HEADER)
+            holder_count = self._stream_holders_to_csv(token_address, chain_id, writer)
+            if holder_count is None:
+                self.logger.warning(f"    Failed to get holders data for {token_symbol} - skipping")
+                return
+            csv_data = buffer.getvalue()
         except Exception as e:
             self.logger.error(f"    Failed to create CSV for {token_symbol}: {e}")
             return
         
-        # Upload to Dune
+        with self._lock:
+            if holder_count:
+                self._empty_tokens_changed |= self._empty_tokens.pop(empty_key, None) is not None
+            else:
+                self._empty_tokens[empty_key] = time.time()
+                self._empty_tokens_changed = True
+        
+        if not holder_count:
+            self.logger.info(f"    No holders for {token_symbol}")
+            return
+        
+        self.logger.info(f"    Found {holder_count} holders for {token_symbol}")
+        
+        if upload_executor is None:
+            self._upload_and_archive(table_name, csv_name, token_symbol, csv_data)
+            return None
+        
+        # Continue with the next token while uploading, but wait if too many CSVs are already queued
+        self._upload_slots.acquire()
+        future = upload_executor.submit(self._upload_and_archive, table_name, csv_name, token_symbol, csv_data)
+        future.add_done_callback(lambda _: self._upload_slots.release())
+        return future
+
+    def _upload_and_archive(self, table_name, csv_name, token_symbol, csv_data):
+        """Upload a token's holders CSV to Dune and archive it"""
         try:
-            with open(csv_path, 'r') as f:
-                csv_data = f.read()
-            
-            table_name = f"{dune_name}_{token_symbol.lower()}_holders"
-            
-            # if env var DRY_RUN is set to true, skip the upload
+            # if env var DRY_RUN is set to true, skip the upload and keep the CSV for inspection
             if os.getenv("DRY_RUN"):
+                csv_path = self.data_dir / csv_name
+                with open(csv_path, 'w', newline='') as f:
+                    f.write(csv_data)
+                self.logger.info(f"    Created CSV: {csv_path}")
                 self.logger.info(f"    Skipping upload for {token_symbol} - DRY_RUN is set")
                 return
 
@@ -155,16 +394,58 @@ class SuperTokenSync(DuneSyncBase):
             
             if success:
                 # Archive immediately after successful processing
-                self.archive_file(csv_path)
+                self.archive_data(csv_data, csv_name)
         except Exception as e:
             self.logger.error(f"    Upload process failed for {token_symbol}: {e}")
+
+    def _empty_tokens_path(self):
+        return self.data_dir / "empty_tokens.json"
+
+    def load_empty_tokens(self):
+        """Load the tokens found without holders by previous runs, dropping expired entries"""
+        path = self._empty_tokens_path()
+        if not path.exists():
+            return {}
         
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+            now = time.time()
+            empty_tokens = {key: ts for key, ts in entries.items() if now - ts < EMPTY_TOKENS_TTL}
+            self._empty_tokens_changed = len(empty_tokens) != len(entries)
+            self.logger.info(f"Loaded {len(empty_tokens)} tokens without holders from {path}")
+            return empty_tokens
+        except Exception as e:
+            self.logger.error(f"Failed to load tokens without holders from {path}: {e}")
+            return {}
+
+    def _empty_token_checked_at(self, key):
+        """Get when a token was found without holders, None if it had holders or wasn't checked"""
+        with self._lock:
+            if self._empty_tokens is None:
+                self._empty_tokens = self.load_empty_tokens()
+            return self._empty_tokens.get(key)
+
+    def save_empty_tokens(self):
+        """Persist the tokens found without holders so they are skipped after a restart"""
+        if not self._empty_tokens_changed:
+            return
         
+        path = self._empty_tokens_path()
+        try:
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self._empty_tokens, f)
+            os.replace(tmp_path, path)
+            self._empty_tokens_changed = False
+        except Exception as e:
+            self.logger.error(f"Failed to save tokens without holders to {path}: {e}")
 
     def sync_once(self):
         """Execute a single sync cycle"""
+        self.refresh_timestamp()
         self.logger.info(f"Starting sync cycle at {self.timestamp}")
-        
+        self._not_found_counts.clear()
         networks = self.get_networks()
         self.logger.info(f"Found {len(networks)} mainnet networks")
         
@@ -173,36 +454,82 @@ class SuperTokenSync(DuneSyncBase):
             networks = networks[:1]
             self.logger.info("DEBUG mode: processing only first network")
         
+        # Skip chains without duneName
+        dune_networks = []
         for network in networks:
-            chain_id = network["chainId"]
-            
-            # Skip chains without duneName
             if not network.get("duneName"):
-                self.logger.info(f"Skipping {network['name']} (chainId {chain_id}) - no Dune support")
+                self.logger.info(f"Skipping {network['name']} (chainId {network['chainId']}) - no Dune support")
                 continue
-            
-            self.logger.info(f"Processing {network['name']} (chainId {chain_id})")
-            
-            tokens = self.get_tokens(network)
-            self.logger.info(f"  Found {len(tokens)} SuperTokens")
-            
-            for token in tokens:
-                self.process_token(token, network)
-                time.sleep(0.5)  # Rate limiting
+            dune_networks.append(network)
+        
+        # Tokens are processed by a bounded pool of workers, holder requests are rate limited per host.
+        # Uploads run on their own workers, so fetching the next tokens overlaps with uploading.
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_executor, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            token_futures = {}
+            futures = []
+            upload_futures = []
+            try:
+                # Query the token lists of all networks up front, each distinct subgraph endpoint only once
+                for network in dune_networks:
+                    endpoint = self._subgraph_endpoint(network)
+                    if endpoint not in token_futures:
+                        token_futures[endpoint] = executor.submit(self.get_tokens, network)
+                
+                for network in dune_networks:
+                    self.logger.info(f"Processing {network['name']} (chainId {network['chainId']})")
+                
+                    tokens = token_futures[self._subgraph_endpoint(network)].result()
+                    self.logger.info(f"  Found {len(tokens)} SuperTokens")
+                
+                    for token in tokens:
+                        futures.append(executor.submit(self.process_token, token, network, upload_executor))
+                
+                for future in futures:
+                    try:
+                        upload_future = future.result()
+                        if upload_future:
+                            upload_futures.append(upload_future)
+                    except Exception as e:
+                        self.logger.error(f"  Token processing failed: {e}")
+                
+                wait(upload_futures)
+            except BaseException:
+                # On errors or Ctrl+C, don't have the executors work off all queued tokens and uploads
+                # before exiting, only what is already running is finished
+                for future in itertools.chain(token_futures.values(), futures, upload_futures):
+                    future.cancel()
+                # Uploads of processed tokens not collected yet
+                for future in futures:
+                    if future.done() and not future.cancelled() and not future.exception() and future.result():
+                        future.result().cancel()
+                raise
+        
+        self.save_empty_tokens()
         
         self.logger.info(f"Sync cycle completed at {self.timestamp}")
 
     def run(self):
         """Main daemon execution loop"""
-        self.logger.info(f"Starting SuperToken Sync Daemon")
+        self.logger.info("Starting SuperToken Sync Daemon")
         self.logger.info(f"Update interval: {self.update_interval} seconds")
-        self.logger.info(f"Press Ctrl+C to stop")
+        self.logger.info("Press Ctrl+C to stop")
         
         try:
+            # Schedule cycles against a monotonic deadline so the time spent syncing doesn't add up to drift
+            next_deadline = time.monotonic()
             while True:
                 self.sync_once()
-                self.logger.info(f"Waiting {self.update_interval} seconds until next sync...")
-                time.sleep(self.update_interval)
+                next_deadline += self.update_interval
+                sleep_for = next_deadline - time.monotonic()
+                if sleep_for <= 0:
+                    # Falling behind: skip the missed runs instead of starting them back to back
+                    missed = int(-sleep_for // self.update_interval) + 1
+                    self.logger.warning(f"Sync cycle took longer than the update interval, skipping {missed} scheduled sync(s)")
+                    next_deadline += missed * self.update_interval
+                    sleep_for = next_deadline - time.monotonic()
+                self.logger.info(f"Waiting {sleep_for:.0f} seconds until next sync...")
+                time.sleep(sleep_for)
         except KeyboardInterrupt:
             self.logger.info("Received keyboard interrupt, shutting down...")
         except Exception as e:
@@ -211,4 +538,13 @@ class SuperTokenSync(DuneSyncBase):
         self.logger.info("SuperToken Sync Daemon stopped")
 
 if __name__ == "__main__":
-    SuperTokenSync().run()
+    parser = argparse.ArgumentParser(description="Sync SuperToken holders to Dune")
+    parser.add_argument("--no-upload", action="store_true",
+                        help="run a single sync cycle and write the CSVs to data/ instead of uploading (same as DRY_RUN)")
+    args = parser.parse_args()
+    
+    if args.no_upload:
+        os.environ["DRY_RUN"] = "1"
+        SuperTokenSync().sync_once()
+    else:
+        SuperTokenSync().run()